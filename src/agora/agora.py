@@ -1,23 +1,34 @@
 #!/usr/bin/env python
 import numpy as np
 import pandas as pd
-import seaborn as sns
 import random
 import re
 import sys
-from pandas_datareader import data as web
-from datetime import datetime, date
+from functools import lru_cache
 
 import utils
 from instrument import Instrument
 from portfolio import Portfolio
 
-tickers_data   = pd.DataFrame(pd.read_csv('data/tickers.csv'))
-tickers        = tickers_data['Symbol'].to_frame()
-stocks_tickers = list(tickers_data.dropna(subset = ['IPOyear'])['Symbol'])
 ##############################################
 #               Ticker Symbols               #
 ##############################################
+@lru_cache(maxsize = 1)
+def load_tickers():
+	'''
+	function:
+		This function reads the available ticker symbols (only the `Symbol`, `IPOyear` columns) from `data/tickers.csv`.
+		The file is read the first time a command needs it, not every time agora is started.
+	'''
+	return pd.read_csv('data/tickers.csv', usecols = ['Symbol', 'IPOyear'])
+
+def stocks_tickers():
+	'''
+	function:
+		This function returns the ticker symbols of stocks (tickers with an IPO year).
+	'''
+	tickers_data = load_tickers()
+	return list(tickers_data.dropna(subset = ['IPOyear'])['Symbol'])
 
 def get_tickers():
 	'''
@@ -42,6 +53,7 @@ def get_tickers():
 		raise ValueError("ERR#0012: There is no ticker starting with this letter.")
 
 	# 3 - function
+	tickers = load_tickers()[['Symbol']]
 
 	if letter == 'all' : 
 		tickers_to_display = tickers
@@ -59,6 +71,28 @@ def get_tickers():
 #############################################
 #              Ticker : Data                #
 #############################################
+def check_date_range(start, end):
+	'''
+	function:
+		This function validates the `start`, `end` dates (formatted as `dd/mm/yyyy`) and returns the date range
+		{'start' : start, 'end' : end} as timestamps.
+	'''
+	# each date is parsed once (by pandas' C parser) & the parsed value is kept
+	try:
+		start = pd.to_datetime(start, format = '%d/%m/%Y')
+	except ValueError:
+		raise ValueError("ERR#0001: incorrect start date format, it should be 'dd/mm/yyyy'.")
+	try:
+		end = pd.to_datetime(end, format = '%d/%m/%Y')
+	except ValueError:
+		raise ValueError("ERR#0002: incorrect en dformat, it should be 'dd/mm/yyyy'.")
+
+	if start >= end:
+		raise ValueError("ERR#0003: `end` should be greater than `start`, both formatted as 'dd/mm/yyyy'.")
+
+	return {'start' : start, 'end' : end}
+
+
 def get_ticker_historical_data(**kwargs):
 	'''
 	function:
@@ -72,6 +106,7 @@ def get_ticker_historical_data(**kwargs):
     	[*] ticker    : The ticker for which historical data are retrieved
     	[*] from_date : Date formatted as `dd/mm/yyyy`, since when data is going to be retrieved.
     	[*] to_date   : Date formatted as `dd/mm/yyyy`, until when data is going to be retrieved.
+    	[*] date_range: The date range already validated by `check_date_range` (optional, replaces from/to dates).
 	'''
 	# 1 - check arguments
 	if kwargs == {}:
@@ -84,42 +119,23 @@ def get_ticker_historical_data(**kwargs):
 		printing = True
 	else:
 		ticker = kwargs['ticker']
-		start  = kwargs['start']
-		end    = kwargs['end']
+		start  = kwargs.get('start')
+		end    = kwargs.get('end')
 		printing = False
 
-	# 2 - check parameter validity
-	# TICKER
-	try :
-		ticker in tickers['Symbol']
-	except ValueError:
-		raise ValueError("ERR#0012: There is no ticker with that name. Check available tickers symbols with : `./agora.py tickers *`")
-
-	# DATETIMES
-	try:
-		datetime.strptime(start, '%d/%m/%Y')
-	except ValueError:
-		raise ValueError("ERR#0001: incorrect start date format, it should be 'dd/mm/yyyy'.")
-	try:
-		datetime.strptime(end, '%d/%m/%Y')
-	except ValueError:
-		raise ValueError("ERR#0002: incorrect en dformat, it should be 'dd/mm/yyyy'.")
-
-	start = datetime.strptime(start, '%d/%m/%Y')
-	end = datetime.strptime(end, '%d/%m/%Y')
+	# 2 - check parameter validity (the ticker symbol is validated by `utils.download_data`)
+	# DATETIMES (unless the caller has already validated them)
+	date_range = kwargs.get('date_range') or check_date_range(start, end)
 
-
-	if start >= end:
-		raise ValueError("ERR#0003: `end` should be greater than `start`, both formatted as 'dd/mm/yyyy'.")
-
-	date_range = {'start' : start, 'end' : end}
-
-	# 3 - Retrieve instrument data
-	instrument = Instrument(ticker, date_range)
+	# 3 - Retrieve instrument data (unless it has already been retrieved)
+	if kwargs.get('data') is not None:
+		instrument = Instrument.from_frame(ticker, date_range, kwargs['data'])
+	else:
+		instrument = Instrument(ticker, date_range)
 	if printing : utils.display(instrument.data.tail(15))
 
 	# 4 - print result
-	messages = [ " Trading for T = {} days ".format(len(instrument.data) ) ]
+	messages = [ " Trading for T = {} days ".format(instrument.n_trading_dates ) ]
 	if printing : utils.pprint(messages)
 
 	return instrument
@@ -144,6 +160,7 @@ def get_ticker_statistics(**kwargs):
     	[*] ticker    : The ticker for which historical data are retrieved
     	[*] start.    : Date formatted as `dd/mm/yyyy`, since when data is going to be retrieved.
     	[*] end       : Date formatted as `dd/mm/yyyy`, until when data is going to be retrieved.
+    	[*] date_range: The date range already validated by `check_date_range` (optional, replaces start/end).
 	'''
 
 	# 1 - check arguments
@@ -157,16 +174,16 @@ def get_ticker_statistics(**kwargs):
 		printing = True
 	else:
 		ticker = kwargs['ticker']
-		start  = kwargs['start']
-		end    = kwargs['end']
+		start  = kwargs.get('start')
+		end    = kwargs.get('end')
 		printing = False
 
 	# 2
 	# 2.1 - Get the data
-	instrument = get_ticker_historical_data(ticker = ticker, start = start, end = end )
+	instrument = get_ticker_historical_data(ticker = ticker, start = start, end = end, date_range = kwargs.get('date_range'),
+											data = kwargs.get('data'))
 
 	# 2.2 - Calculate [*] return 
-	#                 [*] log return 
 	#                 [*] expected daily return
 	#                 [*] expected return
 	instrument.calculate_statistics()
@@ -177,7 +194,7 @@ def get_ticker_statistics(**kwargs):
 	# 4 - print result
 	# RETURN
 	messages = []
-	messages.append(" Expected Total Return  ({} days)  = {} %".format(len(instrument.data) , round(return_statistics['expected_total_return'] * 100, 3)))
+	messages.append(" Expected Total Return  ({} days)  = {} %".format(instrument.n_trading_dates , round(return_statistics['expected_total_return'] * 100, 3)))
 	messages.append(" Expected Annual Return (252 days)  = {} % ".format(round(return_statistics['expected_annual_return'] * 100, 3)))
 	messages.append(" APR = {} % ".format(round(return_statistics['APR'] * 100, 3)))
 	messages.append(" APY = {} % ".format(round(return_statistics['APY'] * 100, 3)))
@@ -185,9 +202,9 @@ def get_ticker_statistics(**kwargs):
 
 	# RISK
 	messages = []
-	messages.append(" Total Standard Deviation  ({} days)  = {}  ".format(len(instrument.data), round(risk_statistics['total_std'], 3)))
+	messages.append(" Total Standard Deviation  ({} days)  = {}  ".format(instrument.n_trading_dates, round(risk_statistics['total_std'], 3)))
 	messages.append(" Annual Standard Deviation (252 days) = {} ".format(round(risk_statistics['annual_std'], 3)))
-	messages.append(" Total Variance  ({} days)  = {}  ".format(len(instrument.data), round(risk_statistics['total_var'], 3)))
+	messages.append(" Total Variance  ({} days)  = {}  ".format(instrument.n_trading_dates, round(risk_statistics['total_var'], 3)))
 	messages.append(" Annual Variance (252 days) = {} ".format(round(risk_statistics['annual_var'], 3)))
 	if printing : utils.pprint(messages)
 
@@ -232,15 +249,17 @@ def get_tickers_statistics(**kwargs):
 		end         = kwargs['end']
 		printing= False
 
-	# 2 - Retrieve Data & Calculate Descriptive statistics for each ticker:
+	# 2 - Retrieve Data (all tickers concurrently) & Calculate Descriptive statistics for each ticker:
+	date_range                  = check_date_range(start, end)
+	frames                      = utils.download_many(ticker_list, date_range['start'], date_range['end'])
 	instrument_list             = []
 	expected_annual_return_list = []
 	annual_std_list             = []
 	for ticker in ticker_list:
-		instrument = get_ticker_statistics(ticker = ticker, start = start, end = end )
+		instrument = get_ticker_statistics(ticker = ticker, date_range = date_range, data = frames[ticker])
 		instrument_list.append(instrument)
-		expected_annual_return_list.append(instrument.return_statistics['expected_annual_return'] * 100)
-		annual_std_list.append(instrument.risk_statistics['annual_std'])
+		expected_annual_return_list.append(instrument.expected_annual_return * 100)
+		annual_std_list.append(instrument.annual_std)
 
 	# 3 - Convert Descriptive statistics from list to dataframes
 	descriptive_dict = {"Expected Annual Return" : expected_annual_return_list,
@@ -315,8 +334,8 @@ def get_tickers_risk_analysis(**kwargs):
 	'''
 	function:
 		This function 
-		1. Uses `get_ticker_risk_analysis` N times, 1 for each ticker instrument. For each instrument
-			1.1. Uses `get_ticker_statistics` to calculate both RETURN & RISK descriptive statistics
+		1. Uses `get_tickers_statistics` to retrieve the N ticker instruments concurrently. For each instrument
+			1.1. Calculates both RETURN & RISK descriptive statistics
 			1.2. Applies 'Capital Asset Pricing Model' to calculate α (alpha),β (beta) , correlation ρ
 			   For all this to succeed we define:
 			   - risk-free rate : the 3month Tbill 
@@ -348,14 +367,14 @@ def get_tickers_risk_analysis(**kwargs):
 		end         = kwargs['end']
 		printing    = False
 
-	# 2 - Retrieve Data & Calculate Descriptive statistics for each ticker:
-	get_tickers_statistics(ticker_list = ticker_list, start = start, end = end)
-	instrument_list             = []
+	# 2 - Retrieve Data (all tickers concurrently) & Calculate Descriptive statistics for each ticker.
+	#     The instruments are reused for the risk analysis instead of being retrieved again one by one.
+	instrument_list, _ = get_tickers_statistics(ticker_list = ticker_list, start = start, end = end)
 	alpha_list, beta_list, correlation_list = [], [], []
 	sharpe_ratio_list, r_squared_list       = [], [] 
 
-	for ticker in ticker_list:
-		instrument = get_ticker_risk_analysis(ticker = ticker, start = start, end = end )
+	for instrument in instrument_list:
+		instrument.risk_analysis()
 		alpha_list.append(instrument.risk_analysis_statistics['alpha'])
 		beta_list.append(instrument.risk_analysis_statistics['beta'])
 		correlation_list.append(instrument.risk_analysis_statistics['correlation'])
@@ -515,6 +534,9 @@ def portfolio_optimization(**kwargs):
     	[*] ticker_list : The ticker list of which portfolio will be constructed
     	[*] start       : Date formatted as `dd/mm/yyyy`, since when data is going to be retrieved.
     	[*] end         : Date formatted as `dd/mm/yyyy`, until when data is going to be retrieved.
+    	[*] engine      : How the portfolios are simulated : 'numpy' (default), 'numba', 'cuda' or 'processes'. See `Portfolio.simulate`.
+    	[*] seed        : Seed of the random weights, for reproducible simulations (optional, not with engine = 'numba').
+    	[*] top_k       : Number of highest Sharpe ratio portfolios highlighted in the plot (default 10).
 	'''
 	# 1 - check arguments
 	if kwargs == {}:
@@ -529,65 +551,57 @@ def portfolio_optimization(**kwargs):
 			ticker_list.append(sys.argv[i])
 		start       = sys.argv[num_tickers + 4]
 		end         = sys.argv[num_tickers + 5]
+		engine      = 'numpy'
+		seed        = None
+		top_k       = 10
 		printing = True
 	else:
 		num_portfolios  = kwargs['num_portfolios']
 		ticker_list 	= kwargs['ticker_list']
 		start       	= kwargs['start']
 		end         	= kwargs['end']
+		engine          = kwargs.get('engine', 'numpy')
+		seed            = kwargs.get('seed')
+		top_k           = kwargs.get('top_k', 10)
 		printing    	= False
 
+	if isinstance(top_k, bool) or not isinstance(top_k, (int, np.integer)) or top_k < 0:
+		raise ValueError("ERR#0021: `top_k` should be a non-negative integer.")
+
 	# 2 - Get the instrument list along with their calculated descriptive statistics
 	instrument_list, descriptive_df = get_tickers_statistics(ticker_list = ticker_list, start = start, end = end)
-	stocks_idx                      = [ idx for idx in range(len(ticker_list)) if ticker_list[idx] in stocks_tickers]
+	stocks_mask                     = np.isin(ticker_list, stocks_tickers())
 	risk_free                       = utils.risk_free_return(date_range = instrument_list[0].date_range)
 	returns_merged                  = utils.merge_instrument_returns(instrument_list = instrument_list, ticker_list = ticker_list)
 
-	# 3 - Portfolio simulation
-	all_weights, ret_arr, std_arr, sharpe_arr = [], [], [], []
-	for i in range(num_portfolios):
-		if i % 100 == 0: print("{} out of {}\n".format(i, num_portfolios), end = '')
-		portfolio = Portfolio(instrument_list = instrument_list, returns_merged = returns_merged , 
-							  ticker_list = ticker_list, risk_free = risk_free)
-
-		# weights
-		portfolio.initialize_weights()
-		w_stocks = sum([ w[i] for i in portfolio.weights if i in stocks_idx ])
-
-		# return, std, sharpe ratio
-		portfolio.calculate_statistics()
-		portfolio_statistics = portfolio.statistics
-		R_P   = portfolio_statistics['portfolio_annual_return']
-		STP_P = portfolio_statistics['portfolio_annual_std']
-		SR_P  = portfolio_statistics['portfolio_annual_sr']
-
-		# append results
-		all_weights.append(portfolio.weights)
-		ret_arr.append(R_P)
-		std_arr.append(STP_P)
-		sharpe_arr.append(SR_P)
+	# 3 - Portfolio simulation (all `num_portfolios` random portfolios at once)
+	portfolio = Portfolio(instrument_list = instrument_list, returns_merged = returns_merged , 
+						  ticker_list = ticker_list, risk_free = risk_free)
+	best_weights, ret_arr, std_arr, sharpe_arr = portfolio.simulate(num_portfolios, engine = engine, seed = seed)
 
 	# 4 - Calculate 2 most efficient portfolios.
 	# [1] Max Sharpe Ratio Portfolio
 	opt_idx = np.argmax(sharpe_arr)
 	opt_sr, opt_ret, opt_std = sharpe_arr[opt_idx], ret_arr[opt_idx], std_arr[opt_idx]
-	opt_weights = all_weights[opt_idx]
+	opt_weights = best_weights['max_sharpe']
 	messages = []
 	messages.append("          * Max Sharpe Ratio optimized Portfolio *          ")
 	messages.append(" Portfolio Annual Return (252 days)  = {} % ".format(round(opt_ret * 100, 3)))
 	messages.append(" Portfolio Annual Standard Deviation  (252 days)  = {}  ".format( round(opt_std, 3)))
 	messages.append(" Portfolio Annual Sharpe Ratio  (252 days)  = {}  ".format( round(opt_sr, 3)))
+	messages.append(" Portfolio Stocks Allocation  = {} % ".format( round(opt_weights[stocks_mask].sum() * 100, 3)))
 	if printing : utils.pprint(messages)
 
 	# [2] Min Standard Deviation Ratio portfolio
 	min_idx = np.argmin(std_arr)
 	min_sr, min_ret, min_std = sharpe_arr[min_idx], ret_arr[min_idx], std_arr[min_idx]
-	min_weights = all_weights[min_idx]
+	min_weights = best_weights['min_std']
 	messages = []
 	messages.append("      * Min Standard Deviation optimized Portfolio *      ")
 	messages.append(" Portfolio Annual Return (252 days)  = {} % ".format(round(min_ret * 100, 3)))
 	messages.append(" Portfolio Annual Standard Deviation  (252 days)  = {}  ".format( round(min_std, 3)))
 	messages.append(" Portfolio Annual Sharpe Ratio  (252 days)  = {}  ".format( round(min_sr, 3)))
+	messages.append(" Portfolio Stocks Allocation  = {} % ".format( round(min_weights[stocks_mask].sum() * 100, 3)))
 	if printing : utils.pprint(messages)
 
 	# [3] weight allocation for both efficient portfolios
@@ -598,7 +612,7 @@ def portfolio_optimization(**kwargs):
 
 	# 5 - Plot the portfolios along with the 2 efficient portfolios.
 	title = "{}_portfolio_simulation".format(num_portfolios)
-	portfolio.plot_portfolio_simulation(title, instrument_list[0].date_range, std_arr,ret_arr, sharpe_arr, descriptive_df, returns_merged)
+	portfolio.plot_portfolio_simulation(title, instrument_list[0].date_range, std_arr,ret_arr, sharpe_arr, descriptive_df, returns_merged, top_k = top_k)
 
 
 	return
@@ -0,0 +1,39 @@
+import math
+from numba import cuda
+from numba.cuda.random import xoroshiro128p_uniform_float64
+
+# CUDA kernels, imported only by `utils.simulate_portfolios_cuda` (engine = 'cuda') so that the GPU toolchain is
+# never loaded otherwise. `cuda` is a module global, which lets NUMBA_ENABLE_CUDASIM=1 run the kernels on the CPU.
+
+@cuda.jit
+def portfolios_kernel(rng_states, mean_returns, cov_matrix, risk_free, all_weights, ret_arr, std_arr, sharpe_arr):
+	'''
+		function:
+			Monte Carlo simulation kernel of `utils.simulate_portfolios_cuda` : 1 thread = 1 portfolio, which draws its
+			own normalized random weights and computes E[R_p] = w * E[R], σ_p = sqrt(w * Cov * w^T * 252) and
+			SR_p = (E[R_p] - R_rf) / σ_p in place.
+	'''
+	p = cuda.grid(1)
+	if p >= all_weights.shape[0]:
+		return
+
+	n     = mean_returns.shape[0]
+	total = 0.0
+	for i in range(n):
+		all_weights[p, i] = xoroshiro128p_uniform_float64(rng_states, p)
+		total            += all_weights[p, i]
+
+	ret, var = 0.0, 0.0
+	for i in range(n):
+		all_weights[p, i] /= total
+		ret += all_weights[p, i] * mean_returns[i]
+
+	for i in range(n):
+		row = 0.0
+		for j in range(n):
+			row += cov_matrix[i, j] * all_weights[p, j]
+		var += all_weights[p, i] * row
+
+	ret_arr[p]    = ret
+	std_arr[p]    = math.sqrt(var * 252)
+	sharpe_arr[p] = (ret - risk_free) / std_arr[p]
@@ -1,16 +1,12 @@
 
 import numpy as np
 import pandas as pd
-import seaborn as sns
-import random
-import re
-import sys
-from pandas_datareader import data as web
-from datetime import datetime, date
+from datetime import datetime
+from functools import cached_property
 
 import utils
 class Instrument():
-	def __init__(self, ticker, date_range):
+	def __init__(self, ticker, date_range, data = None):
 		self.id     = -1
 		self.ticker = ticker
 
@@ -25,61 +21,118 @@ class Instrument():
 			start = (datetime.datetime.now() - datetime.timedelta(days = 365)).strftime("%Y-%m-%d")
 			self.date_range = {"start" : start, "end" : end}
 
-		try:
-			self.download_data(ticker, date_range['start'], date_range['end'])
-		except ValueError:
-			raise ValueError("Invalid ticker symbol specified or else there was not an internet connection available.")
+		if data is not None:
+			self.data = data
+		else:
+			self.download_data(ticker, self.date_range['start'], self.date_range['end'])
+
+		# Only the adjusted close prices are used by the statistics. They are kept as a contiguous float32 array
+		# next to their dates, so that the calculations never index into the whole price dataframe (float32 halves
+		# the memory of long histories, the returns & their moments are still computed in float64).
+		# Occasionally, values of zero are obtained as an asset price. In all likelihood, this value is rubbish
+		# and cannot be trusted, as it implies that the asset has no value. In these cases, we replace the reported
+		# asset price by the last valid price (forward fill), which does not skew the returns the way the mean
+		# of all asset prices would.
+		closing_prices = self.data['Adj Close']
+		self.prices    = closing_prices.mask(closing_prices == 0).ffill().to_numpy(dtype = np.float32, copy = True)
+		self.dates     = self.data.index
 
-		self.return_statistics        = {}
-		self.risk_statistics          = {}
 		self.risk_analysis_statistics = {}
 
+	@classmethod
+	def from_frame(cls, ticker, date_range, data):
+		'''
+		function:
+			Create an instrument from price data that has already been retrieved (e.g by `utils.download_many`),
+			without calling `download_data`.
+		'''
+		return cls(ticker, date_range, data = data)
+
+	# The descriptive statistics are computed on first access (or by `calculate_statistics`) and kept afterwards,
+	# so instruments used only for their price data never pay for them.
+	@cached_property
+	def return_statistics(self):
+		return self.calculate_return_statistics()
+
+	@cached_property
+	def risk_statistics(self):
+		return self.calculate_risk_statistics()
+
+	@cached_property
+	def returns(self):
+		return self.return_statistics['returns']
+
+	@cached_property
+	def expected_annual_return(self):
+		return self.return_statistics['expected_annual_return']
+
+	@cached_property
+	def annual_std(self):
+		return self.risk_statistics['annual_std']
+
+	@cached_property
+	def n_trading_dates(self):
+		return len(self.data)
 
 	def download_data(self, ticker, start, end):
-		data = web.DataReader(ticker, data_source = 'yahoo', start = start, end = end)
-		self.data = data
+		self.data = utils.download_data(ticker, start, end)
 		return 
 
 	def calculate_return_statistics(self):
 		statistics = {}
 
-		# [1] Occasionally, values of zero are obtained as an asset price. In all likelihood, this
-		#	  value is rubbish and cannot be trusted, as it implies that the asset has no value. 
-		#     In these cases, we replace the reported asset price by the mean of all asset prices.
-		closing_prices = self.data['Adj Close'].to_frame()
-		# closing_prices[closing_prices == 0] = closing_prices.mean()
+		# [1] The adjusted close prices (zero prices forward filled) are extracted once, in the constructor.
 
 		#######################################################################
 		#           P_t - P_{t-1}											  #
-		#  [2] R_t = -------------   ,   change_t = log(P_t) - log(P_{t - 1}) #
+		#  [2] R_t = -------------                                            #
 		#             P_{t-1}                                                 #
 		#								   					                  #
 		#      [*] Expected Annual Return  = R_t * 252        			      #
 		#      [*] Annualized Return (APR) = AVG(SUM(R_t per Year))           #
 		#                                                                     #
 		#######################################################################
-		statistics["returns"] = closing_prices.pct_change().dropna()
-		statistics["log_returns"] = closing_prices.apply(lambda x: np.log(x) - np.log(x.shift(1)) ).dropna()
+		#      The math runs on the raw price array; the series is only rebuilt for the callers
+		#      that need the dates (merging returns, correlation with the market).
+		daily_returns, valid, mean, var = utils.daily_returns_moments(self.prices)
+
+		statistics["daily_returns"] = daily_returns
+		statistics["moments"]       = (mean, var)
+		statistics["returns"]       = pd.Series(daily_returns, index = self.dates[1:][valid], name = 'Adj Close')
 
 		# [3] [*] For the expected return, we simply take the mean value of the calculated daily returns.
 		#     [*] Multiply the average daily return by the length of the time series in order to
         #         obtain the expected return over the entire period.
-		cummulative_return = statistics["returns"].iloc[::-1].sum().values[0] 
+		cummulative_return = daily_returns.sum()
+		n                  = len(daily_returns)
 
-		statistics["expected_daily_return"]  = statistics["returns"].mean().values[0] 
-		statistics["expected_total_return"]  = statistics["expected_daily_return"] * len(statistics["returns"])
+		statistics["expected_daily_return"]  = statistics["moments"][0]
+		statistics["expected_total_return"]  = statistics["expected_daily_return"] * n
 		statistics["expected_annual_return"] = statistics["expected_daily_return"] * 252 
-		statistics["APR"]                    = statistics["returns"].resample('Y').sum().mean().values[0]  
-		statistics["APY"]                    = ((1 + cummulative_return)**(252 / len(statistics["returns"]) ) - 1 )
+		statistics["APR"]                    = self.mean_yearly_sum(daily_returns, statistics["returns"].index.year.to_numpy())
+		statistics["APY"]                    = ((1 + cummulative_return)**(252 / n) - 1 )
 
 		self.return_statistics = statistics
-		return 
+		return statistics
+
+	@staticmethod
+	def mean_yearly_sum(values, years):
+		'''
+		function:
+			AVG(SUM(values per Year)). The values are grouped by year with `np.bincount`, in one pass over the data
+			(instead of building a pandas resampler). Years without any value are left out of the average.
+		'''
+		years  = years - years.min()
+		sums   = np.bincount(years, weights = values)
+		counts = np.bincount(years)
+		return sums[counts > 0].mean()
 
 	def calculate_risk_statistics(self):
 		statistics = {}
 
 		# [1] Retrieve Closing prices
-		returns = self.return_statistics['returns']
+		n            = len(self.return_statistics['daily_returns'])
+		_, daily_var = self.return_statistics['moments']
 
 		##############################################################
 		#                 ____________________                       #
@@ -93,8 +146,8 @@ class Instrument():
 		#                                                            #
 		##############################################################
 		# standrd deviation
-		statistics["daily_std"]  = returns.std().values[0]
-		statistics["total_std"]  = statistics["daily_std"] * np.sqrt(len(returns))
+		statistics["daily_std"]  = np.sqrt(daily_var)
+		statistics["total_std"]  = statistics["daily_std"] * np.sqrt(n)
 		statistics["annual_std"] = statistics["daily_std"] * np.sqrt(252)
 
 		# variance
@@ -105,7 +158,7 @@ class Instrument():
 		# statistics["annual_std"] = (returns.resample('Y').std() * np.sqrt(252)).mean().values[0] 
 
 		self.risk_statistics = statistics
-		return 
+		return statistics
 
 	def calculate_statistics(self):
 		self.calculate_return_statistics()
@@ -133,14 +186,14 @@ class Instrument():
 		#                [*] RF : Risk-Free
 		#     Calculate return for the market
 
-		statistics["return_I"]                  = self.return_statistics['returns']
-		statistics["return_M"]                  = market["return_M"]
+		statistics["return_I"]                  = self.returns
+		statistics["return_M"]                  = market["returns_M"]
 		statistics["expected_annual_return_M"]  = market["expected_annual_return_M"]
 		statistics["annual_std_M"]              = market["annual_std_M"]
 		statistics["return_RF"]                 = utils.risk_free_return(date_range = self.date_range)
 
 		# [3] Caclulate correlation ρ_{I,M}
-		statistics["correlation"] = statistics["return_I"].corrwith(statistics["return_M"]).values[0]
+		statistics["correlation"] = statistics["return_I"].corr(statistics["return_M"])
 
 		# [4] Caclulate alpha, beta
 		##########################################################################
@@ -154,8 +207,8 @@ class Instrument():
 		##########################################################################
 		R_RF    = statistics["return_RF"]
 		corr_IM = statistics["correlation"]
-		R_I     = self.return_statistics['expected_annual_return']
-		STD_I   = self.risk_statistics['annual_std']
+		R_I     = self.expected_annual_return
+		STD_I   = self.annual_std
 		
 		R_M     = statistics["expected_annual_return_M"]
 		STD_M   = statistics["annual_std_M"]
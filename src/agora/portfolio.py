@@ -1,14 +1,12 @@
 
 import numpy as np
 import pandas as pd
-import seaborn as sns
 import random
 import re
 import sys
 import matplotlib.pyplot as plt
 import cvxopt as opt
 from cvxopt import solvers
-from pandas_datareader import data as web
 from datetime import datetime, date
 import scipy.optimize as sco
 import utils
@@ -21,22 +19,30 @@ class Portfolio():
 		self.num_instruments    = len(self.instrument_list)
 		self.risk_free          = kwargs['risk_free']
 
-		self.weights            = []
+		self.weights            = np.zeros(self.num_instruments)
 		self.statistics         = {}
-		self.covariance_matrix  = []
+
+		# The expected annual returns E[R_i] & the covariance matrix of the instruments do not depend on the
+		# weights, so they are computed once here and reused by every portfolio statistics calculation.
+		# Everything is kept column-oriented : a (T x N) returns matrix, an (N) vector & an (N x N) matrix.
+		self.returns_matrix     = self.returns_merged.to_numpy(dtype = np.float64)
+		self.mean_returns       = np.fromiter((instrument.expected_annual_return for instrument in self.instrument_list),
+											  dtype = np.float64, count = self.num_instruments)
+		self.covariance_matrix  = self.calculate_covariance_matrix()
 
 		return
 
-	def initialize_weights(self):
+	def initialize_weights(self, seed = None):
 		'''
 		function:
-			For this portfolio we generate random initial weights that are normalized so that : 
+			For this portfolio we generate random initial weights (a contiguous float64 array, seeded with `seed`)
+			that are normalized so that : 
 								######################################
 								##         sum(weights) = 1         ##
 								######################################
 
 		'''
-		weights = np.random.random(self.num_instruments)
+		weights = np.random.default_rng(seed).random(self.num_instruments)
 
 		self.weights = weights / np.sum(weights)
 		return
@@ -61,13 +67,10 @@ class Portfolio():
 	  	#                   σ_p															#
 	  	#################################################################################
 	  	# PORTFOLIO RETURN
-		R_I_list   = [instrument.return_statistics['expected_annual_return'] for instrument in self.instrument_list]
-		statistics["portfolio_annual_return"] = np.sum(R_I_list * self.weights)
+		statistics["portfolio_annual_return"] = self.weights @ self.mean_returns
 
 		# PORFTOLIO STANDARD DEVIATION
-		STD_I_list = [instrument.risk_statistics['annual_std'] for instrument in self.instrument_list]
-		covariance_matrix = self.calculate_covariance_matrix()
-		statistics["portfolio_annual_std"] = np.sqrt(np.dot(self.weights.T, np.dot(covariance_matrix, self.weights))) * np.sqrt(252)
+		statistics["portfolio_annual_std"] = np.sqrt(self.weights @ self.covariance_matrix @ self.weights * 252)
 
 
 		# PORFTOLIO SHARPE RATIO
@@ -93,9 +96,59 @@ class Portfolio():
 			   covariance_matrix[i,j] = covariance between instrument i & instrument j
 
 		'''
-		covariance_matrix = self.returns_merged.cov()
+		covariance_matrix = np.atleast_2d(np.cov(self.returns_matrix, rowvar = False))
 		return covariance_matrix
 
+	def simulate(self, num_portfolios, engine = 'numpy', seed = None, chunk_size = 1 << 15):
+		'''
+		function:
+			Monte Carlo simulation of `num_portfolios` random portfolios. Instead of creating a portfolio & calling
+			`calculate_statistics` once per sample, the random weights are drawn as a (chunk_size x N) matrix at a time
+			(every row normalized so that sum(weights) = 1, as in `initialize_weights`) and the statistics of all
+			portfolios are computed with linear algebra :
+
+								E[R_p] = W * E[R] ,  σ_p^2 = diag(W * Cov * W^T) * 252
+
+			Only the statistics of every portfolio & the weights of the 2 efficient portfolios are kept, so the memory
+			does not grow with P * N. The weights are drawn by a `np.random.Generator`, seeded with `seed` for
+			reproducible runs.
+			With engine = 'numpy' & 'processes' the weights, returns & covariances are float32 (the sampling noise
+			dwarfs the rounding error, and the matrix products move half the memory); the numba & cuda kernels
+			compute in float64. Whatever the engine, the returned weights & statistics are float64.
+			engine = 'numba' runs the same simulation as a compiled kernel, in parallel over all cores. Its threads draw
+			from numba's own per-thread generators, which cannot be seeded reproducibly, so `seed` is rejected.
+			engine = 'cuda' runs it on the GPU, one thread per portfolio (for very large `num_portfolios`).
+			engine = 'processes' splits it into chunks simulated by a pool of worker processes, which does not need numba
+			(see `utils.simulate_portfolios_processes` : spawning the workers only pays off for very large P).
+
+		returns:
+			best_weights ({'max_sharpe' : (N), 'min_std' : (N)}), ret_arr, std_arr, sharpe_arr (P)
+		'''
+		if engine not in ('numpy', 'numba', 'cuda', 'processes'):
+			raise ValueError("ERR#0022: Unknown engine `{}`, it should be 'numpy', 'numba', 'cuda' or 'processes'.".format(engine))
+		if engine == 'numba' and seed is not None:
+			raise ValueError("ERR#0023: engine = 'numba' cannot be seeded, use engine = 'numpy' for reproducible runs.")
+		if engine in ('numba', 'cuda') and not utils.NUMBA_AVAILABLE:
+			raise ValueError("ERR#0024: engine = '{}' requires numba, use engine = 'numpy' or 'processes'.".format(engine))
+
+		mean_returns, cov_matrix = self.mean_returns, self.covariance_matrix
+
+		if engine == 'processes':
+			return utils.simulate_portfolios_processes(mean_returns, cov_matrix, self.risk_free, num_portfolios, seed = seed,
+													   chunk_size = chunk_size)
+		if engine == 'numpy':
+			return utils.simulate_portfolios_stream(mean_returns, cov_matrix, self.risk_free, num_portfolios, seed = seed,
+													chunk_size = chunk_size)
+
+		# the compiled kernels write the weights of every portfolio : keep only the 2 efficient ones
+		if engine == 'numba':
+			results = utils.simulate_portfolios(mean_returns, cov_matrix, self.risk_free, num_portfolios)
+		else:
+			results = utils.simulate_portfolios_cuda(mean_returns, cov_matrix, self.risk_free, num_portfolios, seed = seed)
+		all_weights, ret_arr, std_arr, sharpe_arr = results
+
+		return utils.best_portfolios(all_weights, std_arr, sharpe_arr), ret_arr, std_arr, sharpe_arr
+
 	def track_progress(self, printing, message_optimization, risky):
 
 		portfolio_statistics = self.statistics
@@ -182,15 +235,9 @@ class Portfolio():
 		#                                  SR_optimal                    #
 		##################################################################
 		A = 5
-		cal_x , cal_y, utility = [], [], []
-
-		for E_p in np.linspace(self.risk_free, max(ret_arr) + 0.1, 20):
-			S_p = (E_p - self.risk_free) / opt_sr
-			U_p = E_p - 0.5 * A * (S_p)**2
-
-			cal_x.append(S_p)
-			cal_y.append(E_p)
-			utility.append(U_p)
+		cal_y   = np.linspace(self.risk_free, np.max(ret_arr) + 0.1, 20)
+		cal_x   = (cal_y - self.risk_free) / opt_sr
+		utility = cal_y - 0.5 * A * cal_x**2
 
 		return cal_x, cal_y, utility
 
@@ -226,7 +273,20 @@ class Portfolio():
 		portfolio_stdvs = [np.sqrt(np.matrix(x).T * cov.T.dot(np.matrix(x)))[0,0] for x in portfolio_weights]
 		return portfolio_stdvs, portfolio_returns
 
-	def plot_portfolio_simulation(self, title, date_range, std_arr,ret_arr, sharpe_arr, descriptive_df, returns_merged):
+	def top_sharpe_portfolios(self, sharpe_arr, k):
+		'''
+		function:
+			Indices of the `k` simulated portfolios with the highest Sharpe ratio (unordered). `np.argpartition`
+			selects them in O(P), without sorting all the `P` portfolios.
+		'''
+		if k <= 0:
+			return np.empty(0, dtype = int)
+		k = min(k, len(sharpe_arr))
+		if k == len(sharpe_arr):
+			return np.arange(k)
+		return np.argpartition(sharpe_arr, -k)[-k:]
+
+	def plot_portfolio_simulation(self, title, date_range, std_arr,ret_arr, sharpe_arr, descriptive_df, returns_merged, top_k = 10):
 		# [1] Define the data points for :
 		# # 1.0 - Efficient Frontier
 		# mean_returns = returns_merged.mean() 
@@ -245,6 +305,7 @@ class Portfolio():
 		opt_sr, opt_ret, opt_std = sharpe_arr[opt_idx], ret_arr[opt_idx], std_arr[opt_idx]
 		min_idx = np.argmin(std_arr)
 		min_sr, min_ret, min_std = sharpe_arr[min_idx], ret_arr[min_idx], std_arr[min_idx]
+		top_idx = self.top_sharpe_portfolios(sharpe_arr, top_k)
 
 		# 1.3 -  Capital Allocation Line (CAL)
 		cal_x, cal_y, utility = self.capital_allocation_line(ret_arr ,opt_sr)
@@ -270,6 +331,10 @@ class Portfolio():
 		#                                         [*] Min Standard Deviation
 		plt.scatter(opt_std, opt_ret,marker = (5,1,0),color = 'r',s = 500, label = 'Max Sharpe ratio')
 		plt.scatter(min_std, min_ret, marker = (5,1,0), color = 'g',s = 500,  label = 'Min Volatility ratio')
+		# 2.2.1 - and the rest of the top-K Sharpe ratio portfolios
+		if top_k > 1:
+			plt.scatter(std_arr[top_idx], ret_arr[top_idx], marker = 'o', facecolors = 'none', edgecolors = 'r', s = 80,
+						label = 'Top {} Sharpe ratio'.format(len(top_idx)))
 
 		# 2.3 - plot Market portfolio
 		# plt.scatter(STD_M, R_M, s = 200 ,  alpha = 0.4, edgecolors = "grey", linewidth = 2)
@@ -291,8 +356,6 @@ class Portfolio():
 		# [3] Save the graph
 		plt.savefig(title, bbox_inches = 'tight')
 
-		print(utility)
-
 		return
 
 	def plot_initial_portfolios(self, title, portfolio_arr, descriptive_df):
@@ -1,38 +1,360 @@
 import sys
 import shlex
 import os
+import re
 import subprocess
+import tempfile
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.optimize as sco
+import scipy.linalg as sla
+import numexpr as ne
 from tabulate import tabulate
-from pandas_datareader import data as web
-from functools import reduce
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+try:
+	from numba import njit, prange
+except ImportError:
+	# numba is optional : without it the kernels below are not compiled & engine = 'numba' / 'cuda' are rejected
+	njit, prange = None, range
 
 
 ######################################################
 ##              Finance Related functions           ##
 ######################################################
 portfolios = {'ret' : [], 'std' : [], 'sr': []}
+CACHE_DIR  = os.path.join(os.path.expanduser('~'), '.cache', 'agora')
+TICKER_RE  = re.compile(r'^[A-Za-z0-9.\-^=]{1,12}$')
+NUMBA_AVAILABLE = njit is not None
+
+
+def jit(**options):
+	'''
+		function:
+			`numba.njit(**options)` when numba is installed, otherwise the function is left as plain Python.
+	'''
+	return njit(**options) if NUMBA_AVAILABLE else (lambda function: function)
+
+
+@lru_cache(maxsize = 128)
+def download_data(ticker, start, end):
+	'''
+		function:
+			Retrieve the historical price data of `ticker` from Yahoo Finance!. Data of a date range that
+			is already over never changes, so it is stored under `CACHE_DIR` and read back from disk
+			instead of being downloaded again.
+			The ticker & dates are validated before any request is sent, so that a typo fails immediately.
+	'''
+	if not isinstance(ticker, str) or not TICKER_RE.match(ticker):
+		raise ValueError("ERR#0012: Invalid ticker symbol `{}`.".format(ticker))
+	try:
+		start, end = pd.Timestamp(start), pd.Timestamp(end)
+	except (TypeError, ValueError):
+		raise ValueError("ERR#0004: Invalid date range `{}` - `{}`.".format(start, end))
+	path       = os.path.join(CACHE_DIR, "{}_{:%Y%m%d}_{:%Y%m%d}.parquet".format(ticker, start, end))
+	if os.path.exists(path):
+		return pd.read_parquet(path)
+
+	# pandas_datareader (& its requests stack) is only imported when the data is not cached yet
+	from pandas_datareader import data as web
+
+	data = web.DataReader(ticker, data_source = 'yahoo', start = start, end = end)
+	if end < pd.Timestamp.today().normalize():
+		# write to a temporary file & move it into place at once : an interrupted write or 2 threads downloading
+		# the same ticker never leave a truncated file at `path`
+		os.makedirs(CACHE_DIR, exist_ok = True)
+		fd, tmp_path = tempfile.mkstemp(suffix = '.parquet.tmp', dir = CACHE_DIR)
+		os.close(fd)
+		try:
+			data.to_parquet(tmp_path, compression = 'zstd')
+			os.replace(tmp_path, path)
+		except BaseException:
+			os.remove(tmp_path)
+			raise
+	return data
+
+
+def download_many(ticker_list, start, end, max_workers = 16):
+	'''
+		function:
+			Retrieve the historical price data of all tickers in `ticker_list`. Each download is dominated by
+			the network round-trip, so they are overlapped in a thread pool instead of running one after the other.
+			Returns a dict : ticker -> dataframe
+	'''
+	with ThreadPoolExecutor(max_workers = max_workers) as executor:
+		frames = executor.map(lambda ticker: download_data(ticker, start, end), ticker_list)
+		return dict(zip(ticker_list, frames))
 
 
 def merge_instrument_returns(instrument_list, ticker_list ):
-	returns = [ instrument.return_statistics['returns'] for instrument in instrument_list ]
-	returns_df = reduce(lambda left,right: pd.merge(left,right, left_index = True, right_index = True), returns)
+	returns = [ instrument.returns for instrument in instrument_list ]
+	returns_df = pd.concat(returns, axis = 1, join = 'inner')
 	returns_df.columns = ticker_list
 
 	return returns_df
 
 
+@jit(cache = True)
+def daily_returns_moments(prices):
+	'''
+		function:
+			Daily returns R_t = P_t / P_{t-1} - 1 of `prices` together with their mean & sample variance (ddof = 1),
+			all computed in a single fused pass over the prices (Welford's algorithm). Returns that are NaN are skipped.
+			The prices may be stored as float32, every price is promoted so that the returns & moments are float64.
+
+		returns:
+			(returns, valid, mean, var) where `valid[t - 1]` tells whether date t has a return
+	'''
+	n           = max(prices.shape[0] - 1, 0)
+	returns     = np.empty(n)
+	valid       = np.zeros(n, dtype = np.bool_)
+	k, mean, M2 = 0, 0.0, 0.0
+	for t in range(n):
+		r = np.float64(prices[t + 1]) / np.float64(prices[t]) - 1.0
+		if np.isnan(r):
+			continue
+
+		valid[t]   = True
+		returns[k] = r
+		k         += 1
+		delta      = r - mean
+		mean      += delta / k
+		M2        += delta * (r - mean)
+
+	if k < 2:
+		return returns[:k], valid, mean, np.nan
+	return returns[:k], valid, mean, M2 / (k - 1)
+
+
+def daily_returns_moments_numpy(prices):
+	'''
+		function:
+			Vectorized equivalent of `daily_returns_moments`, used instead of it when numba is not installed (the
+			Python loop of the kernel would then be slow).
+	'''
+	prices  = np.asarray(prices, dtype = np.float64)
+	returns = prices[1:] / prices[:-1] - 1.0
+	valid   = ~np.isnan(returns)
+	returns = returns[valid]
+	mean    = returns.mean() if returns.shape[0] > 0 else 0.0
+	var     = returns.var(ddof = 1) if returns.shape[0] > 1 else np.nan
+	return returns, valid, mean, var
+
+if not NUMBA_AVAILABLE:
+	daily_returns_moments = daily_returns_moments_numpy
+
+
+@jit(parallel = True, fastmath = True, cache = True)
+def simulate_portfolios(mean_returns, cov_matrix, risk_free, num_portfolios):
+	'''
+		function:
+			Compiled Monte Carlo simulation of `num_portfolios` random portfolios (see `Portfolio.simulate`). The
+			portfolios are spread over all cores : each one draws its own normalized random weights and computes
+			E[R_p] = w * E[R], σ_p = sqrt(w * Cov * w^T * 252) and SR_p = (E[R_p] - R_rf) / σ_p in place.
+
+		returns:
+			all_weights (P x N), ret_arr, std_arr, sharpe_arr (P)
+	'''
+	n           = mean_returns.shape[0]
+	all_weights = np.empty((num_portfolios, n))
+	ret_arr     = np.empty(num_portfolios)
+	std_arr     = np.empty(num_portfolios)
+	sharpe_arr  = np.empty(num_portfolios)
+
+	for p in prange(num_portfolios):
+		total = 0.0
+		for i in range(n):
+			all_weights[p, i] = np.random.random()
+			total            += all_weights[p, i]
+
+		ret, var = 0.0, 0.0
+		for i in range(n):
+			all_weights[p, i] /= total
+			ret += all_weights[p, i] * mean_returns[i]
+
+		for i in range(n):
+			row = 0.0
+			for j in range(n):
+				row += cov_matrix[i, j] * all_weights[p, j]
+			var += all_weights[p, i] * row
+
+		ret_arr[p]    = ret
+		std_arr[p]    = np.sqrt(var * 252)
+		sharpe_arr[p] = (ret - risk_free) / std_arr[p]
+
+	return all_weights, ret_arr, std_arr, sharpe_arr
+
+
+def simulate_portfolios_cuda(mean_returns, cov_matrix, risk_free, num_portfolios, seed = None, threads_per_block = 256):
+	'''
+		function:
+			Monte Carlo simulation of `num_portfolios` random portfolios on the GPU (see `Portfolio.simulate`), one
+			CUDA thread per portfolio, each one with its own xoroshiro128+ random number generator.
+
+		returns:
+			all_weights (P x N), ret_arr, std_arr, sharpe_arr (P)
+	'''
+	# numba.cuda & the kernel are only imported here, so that the GPU toolchain is never loaded otherwise
+	from numba import cuda
+	from numba.cuda.random import create_xoroshiro128p_states
+	from cuda_kernels import portfolios_kernel
+
+	if not cuda.is_available():
+		raise RuntimeError("ERR#0020: engine = 'cuda' requires a CUDA capable GPU.")
+
+	n          = mean_returns.shape[0]
+	seed       = np.random.SeedSequence(seed).generate_state(1)[0]
+	rng_states = create_xoroshiro128p_states(num_portfolios, seed = seed)
+
+	all_weights = cuda.device_array((num_portfolios, n), dtype = np.float64)
+	ret_arr     = cuda.device_array(num_portfolios, dtype = np.float64)
+	std_arr     = cuda.device_array(num_portfolios, dtype = np.float64)
+	sharpe_arr  = cuda.device_array(num_portfolios, dtype = np.float64)
+
+	blocks = (num_portfolios + threads_per_block - 1) // threads_per_block
+	portfolios_kernel[blocks, threads_per_block](rng_states, cuda.to_device(mean_returns), cuda.to_device(cov_matrix),
+										     risk_free, all_weights, ret_arr, std_arr, sharpe_arr)
+
+	return all_weights.copy_to_host(), ret_arr.copy_to_host(), std_arr.copy_to_host(), sharpe_arr.copy_to_host()
+
+
+def simulate_portfolios_numpy(mean_returns, cov_matrix, risk_free, num_portfolios, seed = None):
+	'''
+		function:
+			Vectorized Monte Carlo simulation of `num_portfolios` random portfolios (see `Portfolio.simulate`). All the
+			random weights are drawn at once as a (P x N) float32 matrix, every row normalized so that sum(weights) = 1.
+			`seed` is anything `np.random.default_rng` accepts (None, an int or a `np.random.SeedSequence`).
+			The variances use the Cholesky factor of the covariance matrix, factorized once for all portfolios :
+
+								Cov = L * L^T  =>  σ_p^2 = || w_p * L ||^2
+
+			i.e. a single (P x N) * (N x N) matrix product instead of the batched quadratic form. A covariance matrix
+			that is not positive definite (e.g. 2 identical instruments) falls back to the quadratic form.
+
+		returns:
+			all_weights (P x N), ret_arr, std_arr, sharpe_arr (P)
+	'''
+	rng          = np.random.default_rng(seed)
+	all_weights  = rng.random((num_portfolios, mean_returns.shape[0]), dtype = np.float32)
+	all_weights /= all_weights.sum(axis = 1, keepdims = True)
+
+	# the elementwise steps are fused by numexpr (multi-threaded, without temporary arrays)
+	ret_arr    = (all_weights @ mean_returns.astype(np.float32)).astype(np.float64)
+	try:
+		L       = sla.cholesky(cov_matrix, lower = True).astype(np.float32)
+		Y       = all_weights @ L
+		var_arr = np.einsum('pi,pi->p', Y, Y).astype(np.float64)
+	except sla.LinAlgError:
+		var_arr = np.einsum('pi,ij,pj->p', all_weights, cov_matrix.astype(np.float32), all_weights).astype(np.float64)
+	std_arr    = ne.evaluate('sqrt(var_arr * 252)')
+	sharpe_arr = ne.evaluate('(ret_arr - risk_free) / std_arr')
+
+	return all_weights, ret_arr, std_arr, sharpe_arr
+
+
+def best_portfolios(all_weights, std_arr, sharpe_arr):
+	'''
+		function:
+			Weights of the 2 efficient portfolios among the simulated ones :
+				[*] max_sharpe : Max Sharpe Ratio portfolio
+				[*] min_std    : Min Standard Deviation portfolio
+			as float64 copies, whatever the dtype of `all_weights` (float32 for the numpy engine).
+	'''
+	return {'max_sharpe' : all_weights[np.argmax(sharpe_arr)].astype(np.float64),
+			'min_std'    : all_weights[np.argmin(std_arr)].astype(np.float64)}
+
+
+def simulate_portfolios_stream(mean_returns, cov_matrix, risk_free, num_portfolios, seed = None, chunk_size = 1 << 15):
+	'''
+		function:
+			`simulate_portfolios_numpy` in chunks of `chunk_size` portfolios, so that the (P x N) weights matrix is never
+			allocated : only the returns, standard deviations & Sharpe ratios of every portfolio are kept (for the plot),
+			along with the weights of the best portfolio so far for each objective. The peak memory of the weights is
+			O(chunk_size * N) instead of O(P * N). All chunks draw from the same random stream, seeded with `seed`.
+
+		returns:
+			best_weights ({'max_sharpe' : (N), 'min_std' : (N)}), ret_arr, std_arr, sharpe_arr (P)
+	'''
+	rng          = np.random.default_rng(seed)
+	ret_arr      = np.empty(num_portfolios)
+	std_arr      = np.empty(num_portfolios)
+	sharpe_arr   = np.empty(num_portfolios)
+	best_weights = {}
+	best_sr, best_std = -np.inf, np.inf
+
+	for start in range(0, num_portfolios, chunk_size):
+		stop = min(start + chunk_size, num_portfolios)
+		weights, ret_arr[start:stop], std_arr[start:stop], sharpe_arr[start:stop] = simulate_portfolios_numpy(
+			mean_returns, cov_matrix, risk_free, stop - start, seed = rng)
+
+		# keep the best portfolios so far ( strict comparisons : the first one wins ties, as with argmax / argmin )
+		chunk_best = best_portfolios(weights, std_arr[start:stop], sharpe_arr[start:stop])
+		if sharpe_arr[start:stop].max() > best_sr:
+			best_sr                    = sharpe_arr[start:stop].max()
+			best_weights['max_sharpe'] = chunk_best['max_sharpe']
+		if std_arr[start:stop].min() < best_std:
+			best_std                   = std_arr[start:stop].min()
+			best_weights['min_std']    = chunk_best['min_std']
+
+	return best_weights, ret_arr, std_arr, sharpe_arr
+
+
+def simulate_portfolios_chunk(args):
+	'''
+		function:
+			Worker of `simulate_portfolios_processes` : unpack the arguments of one chunk & simulate it.
+	'''
+	return simulate_portfolios_stream(*args)
+
+
+def simulate_portfolios_processes(mean_returns, cov_matrix, risk_free, num_portfolios, seed = None, processes = None,
+								  chunk_size = 1 << 15):
+	'''
+		function:
+			Monte Carlo simulation of `num_portfolios` random portfolios split into one chunk per worker process : a
+			multi-core alternative to engine = 'numba' that does not need numba. Every chunk is streamed by
+			`simulate_portfolios_stream` with its own independent random stream, spawned from `seed`, so that the result
+			is reproducible for a given `seed` & number of processes. The chunks are concatenated back in order & the
+			best portfolios of all chunks are kept.
+			Every worker is a freshly spawned interpreter that imports the caller's modules again (about a second each),
+			so this only pays off for very large `num_portfolios`. Each worker gets at least `chunk_size` portfolios, and
+			a simulation that fits in a single chunk runs in this process, without any pool.
+
+		returns:
+			best_weights ({'max_sharpe' : (N), 'min_std' : (N)}), ret_arr, std_arr, sharpe_arr (P)
+	'''
+	processes = max(min(processes or multiprocessing.cpu_count(), num_portfolios // chunk_size), 1)
+	sizes     = np.full(processes, num_portfolios // processes)
+	sizes[:num_portfolios % processes] += 1
+	seeds     = np.random.SeedSequence(seed).spawn(processes)
+	if processes == 1:
+		return simulate_portfolios_stream(mean_returns, cov_matrix, risk_free, num_portfolios, seed = seeds[0],
+										  chunk_size = chunk_size)
+
+	# the workers are spawned, not forked : the numba parallel runtime (engine = 'numba') is not fork-safe
+	with multiprocessing.get_context('spawn').Pool(processes) as pool:
+		chunks = pool.map(simulate_portfolios_chunk, [(mean_returns, cov_matrix, risk_free, int(size), chunk_seed, chunk_size)
+													  for size, chunk_seed in zip(sizes, seeds)])
+
+	best_weights = {'max_sharpe' : chunks[np.argmax([chunk[3].max() for chunk in chunks])][0]['max_sharpe'],
+					'min_std'    : chunks[np.argmin([chunk[2].min() for chunk in chunks])][0]['min_std']}
+
+	return (best_weights,) + tuple(np.concatenate(arrays) for arrays in list(zip(*chunks))[1:])
+
+
 def risk_free_return(date_range):
 	'''
 		function:
 			Retrieve Data for [*] Risk-free instrument : ^IRX or 3month Tbill
 	'''
-	start, end = date_range['start'], date_range['end']
-	risk_free  = web.DataReader('^IRX', data_source = 'yahoo', start = start, end = end)['Adj Close'].to_frame()
-	risk_free_return  = risk_free.pct_change().dropna().mean().values[0]
+	return risk_free_return_between(date_range['start'], date_range['end'])
+
+@lru_cache(maxsize = 32)
+def risk_free_return_between(start, end):
+	risk_free  = download_data('^IRX', start, end)['Adj Close']
+	risk_free_return  = risk_free.pct_change().dropna().mean()
 	return risk_free_return 
 
 def market_info(date_range):
@@ -40,11 +362,14 @@ def market_info(date_range):
 		function:
 			Retrieve Data for [*] Market instrument : ^GSPC or S&P500
 	'''
-	start, end       = date_range['start'], date_range['end']
-	market           = web.DataReader('^GSPC', data_source = 'yahoo', start = start, end = end)['Adj Close'].to_frame()
+	return market_info_between(date_range['start'], date_range['end'])
+
+@lru_cache(maxsize = 32)
+def market_info_between(start, end):
+	market           = download_data('^GSPC', start, end)['Adj Close']
 	returns_m        = market.pct_change().dropna()
-	annual_return_m  = returns_m.mean().values[0] * 252 
-	annul_std_m      = returns_m.std().values[0] * np.sqrt(252)
+	annual_return_m  = returns_m.mean() * 252 
+	annul_std_m      = returns_m.std() * np.sqrt(252)
 	result = {"returns_M" : returns_m, 
 			  "expected_annual_return_M" : annual_return_m, 
 			  "annual_std_M" : annul_std_m}